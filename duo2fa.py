@@ -1,10 +1,20 @@
 import contextlib
-import inspect
-import uuid
-import hashlib
+import re
+import sys
 
+from collections import namedtuple
 from functools import lru_cache
+from functools import update_wrapper
+from threading import Condition
+from threading import RLock
+from threading import Thread
+from cachetools import cached
+from cachetools import Cache
+from cachetools import TTLCache
+from cachetools.keys import hashkey
 from decouple import config
+from decouple import Csv
+from decouple import undefined
 from errbot import BotPlugin
 from errbot import botcmd
 from errbot import arg_botcmd
@@ -12,36 +22,208 @@ from errbot import cmdfilter
 from errbot.backends.base import Message as ErrbotMessage
 from errbot.botplugin import ValidationException
 from duo_client import Auth
+from typing import Callable
+from typing import Iterable
+from typing import List
 from typing import Mapping
 from typing import Tuple
 
+# 2fa methods a user can pass after --2fa
+_VALID_2FA_METHODS = frozenset(('auto', 'push', 'phone', 'sms'))
+
+# preauth results worth caching. deny and enroll are re-checked every time so a fix on the Duo side applies at once
+_CACHEABLE_PREAUTH_RESULTS = frozenset(('allow', 'auth'))
+
+# matches the first standalone --2fa and, unless it is another flag, the word after it as the 2fa method. Any word is
+# captured so duo2fa_filter can tell the user their method is invalid
+_TWOFA_ARG_RE = re.compile(r"(?:^|\s)--2fa(?=\s|$)(?:\s+(?!--)(\S+))?")
+
+# settings that must come from the plugin configuration or the environment
+_REQUIRED_CONFIG_KEYS = ('DUO_API_HOST', 'DUO_INT_KEY', 'DUO_SECRET_KEY')
+
+# messages sent by duo2fa_filter. Static ones are sent as is, templates are filled in with str.format
+_MSG_REQUIRES_2FA = "This command requires Duo Two Factor. Rerun this command with --2fa.\n" \
+                    "You can specify your preferred 2fa method after --2fa like this `--2fa sms`\n" \
+                    "Just sending --2fa is the same as --2fa auto. Allowed 2fa Methods:\n" \
+                    "auto\npush\nphone\nsms"
+_MSG_INVALID_METHOD_TPL = "{} is not a valid 2fa method. Allowed 2fa Methods:\nauto\npush\nphone\nsms"
+_MSG_UNSUPPORTED_BACKEND = "Fatal error: Your backend does not support user emails. All Duo 2fa commands will fail. " \
+                           "Contact your bot admins to disable Duo 2fa"
+_MSG_SLACK_ERROR = "Fatal error: Unable to look up your email from Slack. Please try again."
+_MSG_DUO_API_ERROR_TPL = "Fatal Error when talking to the Duo api {}"
+_MSG_DENIED_TPL = "Error: You are not authorized to auth to Duo at this time. Please contact your Duo admin.\n" \
+                  "Duo Error message: {}"
+_MSG_NOT_ENROLLED_TPL = "Error: You are not enrolled in Duo. Please contact your Duo admin.\nUser Email: {}"
+# the Duo status message always goes on the end, so this one is a prefix to concatenate rather than a template
+_MSG_AUTH_FAILED_PREFIX = "Your Duo 2FA auth failed.\nError message: "
+
+
+@lru_cache(maxsize=8)
+def env_default(key: str, default: str = undefined) -> str:
+    """
+    Reads a configuration default from the environment or .env file via decouple, caching the result so repeat
+    configure() calls don't re-read the environment
+
+    A missing key without a default raises decouple.UndefinedValueError, which is not cached
+    Args:
+        key (str): name of the setting
+        default (str): value to use when the setting isn't set
+
+    Returns:
+        str
+    """
+    return config(key, default=default, cast=str)
+
+
+@lru_cache(maxsize=1024)
+def parse_2fa_args(args: str) -> Tuple[str, str]:
+    """
+    Parses the 2fa method out of args and returns the args string without 2fa in it
+    Args:
+        args (str): args to parse
+
+    Returns:
+        Tuple(str, str) - twofa_method, args without --2fa method
+    """
+
+    # if --2fa isn't in our args, return None and args unmodified
+    if "--2fa" not in args:
+        return None, args
+
+    match = _TWOFA_ARG_RE.search(args)
+    # --2fa was only part of a longer word, like --2fast
+    if match is None:
+        return None, args
+
+    # no word after --2fa, or the next word is another flag, means auto
+    twofa_method = match.group(1)
+    twofa_method = "auto" if twofa_method is None else twofa_method.lower()
+
+    # splice --2fa and its method out and close the gap with one space. Whitespace anywhere else, like newlines or
+    # runs of spaces inside quotes, reaches the command untouched
+    return twofa_method, (args[:match.start()].rstrip() + " " + args[match.end():].lstrip()).strip()
+
+
+def _command_set(commands: Iterable[str]) -> set:
+    """
+    Turns the commands passed to add_commands/remove_commands into a set
+
+    A str is itself an iterable of str, so without this check add_commands("foo") would filter "f" and "o"
+    Args:
+        commands (Iterable[str]): commands to turn into a set
+
+    Returns:
+        set
+
+    Raises:
+        TypeError: commands is a single str
+    """
+    if isinstance(commands, str):
+        raise TypeError(f"Expected a collection of commands, got the str {commands!r}. Use add_command or "
+                        f"remove_command for a single command")
+    return set(commands)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def access_count_cached(cache: Cache, uses: int, cacheable: Callable = None) -> Callable:
+    """
+    Decorator like cachetools.cached, except each entry is evicted after it has been served from the cache `uses`
+    times, forcing a fresh call
+
+    Like cached(info=True), the wrapped function gets cache_clear() and cache_info()
+    Args:
+        cache (cachetools.Cache): cache to store results in
+        uses (int): number of cache hits an entry is good for
+        cacheable (Callable): optional predicate on a result, results it returns False for are not cached
+
+    Returns:
+        Callable
+    """
+    def decorator(func: Callable) -> Callable:
+        lock = RLock()
+        hits = misses = 0
+
+        def wrapper(*args, **kwargs):
+            nonlocal hits, misses
+            key = hashkey(*args, **kwargs)
+            with lock:
+                # entries are stored as [value, uses remaining]
+                entry = cache.get(key)
+                if entry is not None:
+                    hits += 1
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del cache[key]
+                    return entry[0]
+                misses += 1
+            value = func(*args, **kwargs)
+            if cacheable is not None and not cacheable(value):
+                return value
+            with lock:
+                cache[key] = [value, uses]
+            return value
+
+        def cache_clear() -> None:
+            nonlocal hits, misses
+            with lock:
+                cache.clear()
+                hits = misses = 0
+
+        def cache_info() -> CacheInfo:
+            with lock:
+                return CacheInfo(hits, misses, cache.maxsize, cache.currsize)
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_info = cache_info
+        return update_wrapper(wrapper, func)
+
+    return decorator
+
 
 class Duo2fa(BotPlugin):
     """
     This implements duo 2fa as a cmdfilter for other plugin commands
     """
     # Plugin Setup Methods
-    def __hash__(self) -> int:
-        """
-        Returns a hash of self.cache_id with Duo2fa, needed for LRU caching
-
-        Returns:
-            hash
-        """
-        return hash(hashlib.md5(f"Duo2fa-{self.cache_id}".encode('utf-8')).hexdigest())
-
     def __init__(self, bot, name=None) -> None:
         """
         Calls super init and adds a few variables of our own
         """
         super().__init__(bot=bot,
                          name=name)
-        # cache_id is used to make the object uniquely hashable for lru caching
-        self.cache_id = str(uuid.uuid4())
+        # our caches are built per instance so they are keyed only on their arguments, not on self
+        # emails expire after an hour so address changes get picked up. Errors raise, so they are never cached
+        # the condition makes concurrent misses for the same user wait on the one in flight Slack call
+        email_cache_lock = RLock()
+        self.get_email_via_api = cached(cache=TTLCache(maxsize=256, ttl=3600),
+                                        lock=email_cache_lock,
+                                        condition=Condition(email_cache_lock),
+                                        info=True)(self._get_email_via_api)
+        # preauth cache. Its TTL is configurable, so it is built in activate once the configuration is known
+        self.preauth_user = None
+
+        # maps a Duo preauth result to the method that handles it in duo2fa_filter
+        self._preauth_handlers = {
+            "deny": self._handle_preauth_deny,
+            "enroll": self._handle_preauth_enroll,
+            "allow": self._handle_preauth_allow,
+            "auth": self._handle_preauth_auth,
+        }
+
+        # in memory snapshot of the stored filtered_commands, so membership checks never hit storage.
+        # loaded in activate and replaced, never mutated, by add_command/remove_command, which write it through to
+        # storage. Swapping in a new frozenset means the cmdfilter never sees a set that is mid update
+        self._filtered_commands = frozenset()
 
         # this is our duo auth client. Setting it to None for now, will set it up in activate
         self.duo_auth_api = None
 
+        # the backend mode never changes once the bot is running, so snapshot it once
+        self._bot_mode = bot.mode
+        self._test_mode = self._bot_mode == "test"
+
     def activate(self)->None:
         """
         Activate activates our plugin and sets up some things it needs
@@ -52,12 +234,29 @@ class Duo2fa(BotPlugin):
         super().activate()
         if 'filtered_commands' not in self:
             self['filtered_commands'] = set()
+        self._filtered_commands = frozenset(self['filtered_commands'])
 
         self.duo_auth_api = Auth(ikey=self.config['DUO_INT_KEY'],
                                  skey=self.config['DUO_SECRET_KEY'],
                                  host=self.config['DUO_API_HOST'])
 
-    def configure(self, configuration: Mapping = dict())->None:
+        # a preauth result is reused for at most PREAUTH_TTL seconds or 10 times before we ask Duo again, so a
+        # decision can't go stale. Only results that let the user carry on are cached, so a user who is denied or
+        # not enrolled yet gets through as soon as their Duo admin fixes it
+        self.preauth_user = access_count_cached(
+            cache=TTLCache(maxsize=512, ttl=self.config['PREAUTH_TTL']),
+            uses=10,
+            cacheable=lambda preauth: preauth[0] in _CACHEABLE_PREAUTH_RESULTS
+        )(self._preauth_user)
+
+        # only slack needs an api call to look up emails, so that's the only cache worth warming
+        if self._bot_mode == "slack" and self.config['WARMUP_USER_IDS']:
+            Thread(target=self.warm_email_cache,
+                   args=(self.config['WARMUP_USER_IDS'],),
+                   name="duo2fa-email-warmup",
+                   daemon=True).start()
+
+    def configure(self, configuration: Mapping = None)->None:
         """
         Configure gathers configuration from the user or from the environment and configures the plugin
 
@@ -66,19 +265,32 @@ class Duo2fa(BotPlugin):
 
         Returns:
             None
+
+        Raises:
+            errbot.utils.ValidationException: PREAUTH_TTL is not a positive integer
         """
         if configuration is None:
             configuration = dict()
 
-        if 'DUO_API_HOST' not in configuration:
-            configuration['DUO_API_HOST'] = config("DUO_API_HOST",
-                                                   cast=str)
-        if 'DUO_INT_KEY' not in configuration:
-            configuration['DUO_INT_KEY'] = config("DUO_INT_KEY",
-                                                  cast=str)
-        if 'DUO_SECRET_KEY' not in configuration:
-            configuration['DUO_SECRET_KEY'] = config("DUO_SECRET_KEY",
-                                                     cast=str)
+        # not setdefault: that would read the environment, and raise for unset keys, even when a key is configured
+        for key in _REQUIRED_CONFIG_KEYS:
+            if key not in configuration:
+                configuration[key] = env_default(key)
+        if 'WARMUP_USER_IDS' not in configuration:
+            configuration['WARMUP_USER_IDS'] = Csv()(env_default("WARMUP_USER_IDS", default=""))
+        elif isinstance(configuration['WARMUP_USER_IDS'], str):
+            # direct configure() callers may pass "U1,U2". Without this warm_email_cache would look up each character
+            configuration['WARMUP_USER_IDS'] = Csv()(configuration['WARMUP_USER_IDS'])
+        if 'PREAUTH_TTL' not in configuration:
+            configuration['PREAUTH_TTL'] = env_default("PREAUTH_TTL", default="300")
+        # activate builds the preauth cache from this. 0 or less would quietly turn the cache off
+        try:
+            preauth_ttl = int(configuration['PREAUTH_TTL'])
+        except (TypeError, ValueError):
+            raise ValidationException(f"PREAUTH_TTL must be an integer, got {configuration['PREAUTH_TTL']!r}")
+        if preauth_ttl <= 0:
+            raise ValidationException(f"PREAUTH_TTL must be greater than 0, got {preauth_ttl}")
+        configuration['PREAUTH_TTL'] = preauth_ttl
 
         super().configure(configuration)
 
@@ -100,9 +312,9 @@ class Duo2fa(BotPlugin):
         """
         super().check_configuration(configuration)
 
-        # if we're in test mode, just pass and don't try to check on the duo auth
-        if self._bot.mode == "test":
-            pass
+        # if we're in test mode, don't try to check on the duo auth
+        if self._test_mode:
+            return
 
         duo_auth_api = Auth(ikey=configuration['DUO_INT_KEY'],
                             skey=configuration['DUO_SECRET_KEY'],
@@ -138,14 +350,13 @@ class Duo2fa(BotPlugin):
                       in_reply_to=msg)
             return
 
-        with self.stored('filtered_commands') as filtered_commands:
-            if command in filtered_commands:
-                self.send(
-                    msg.to,
-                    text=f"{command} already requires 2fa",
-                    in_reply_to=msg
-                )
-                return
+        if command in self._filtered_commands:
+            self.send(
+                msg.to,
+                text=f"{command} already requires 2fa",
+                in_reply_to=msg
+            )
+            return
 
         self.add_command(command)
         self.send(msg.to,
@@ -170,14 +381,13 @@ class Duo2fa(BotPlugin):
         Returns:
             None
         """
-        with self.stored('filtered_commands') as filtered_commands:
-            if command not in filtered_commands:
-                self.send(
-                    msg.to,
-                    text=f"{command} does not require 2fa",
-                    in_reply_to=msg
-                )
-                return None
+        if command not in self._filtered_commands:
+            self.send(
+                msg.to,
+                text=f"{command} does not require 2fa",
+                in_reply_to=msg
+            )
+            return None
 
         self.remove_command(command)
         self.send(
@@ -231,6 +441,50 @@ class Duo2fa(BotPlugin):
         )
         return
 
+    @botcmd(admin_only=True)
+    def twofa_preauth_cache_clear(self, msg: ErrbotMessage, args: Mapping) -> None:
+        """
+        This is an admin only command that will clear the Duo preauth cache
+
+        Args:
+            msg (ErrbotMessage): ErrbotMessage object
+            args (Mapping):args
+
+        Returns:
+            None
+        """
+        self.log.debug(f"Clearing preauth cache @ {msg.frm} request")
+        self.preauth_user.cache_clear()
+        self.send(
+            msg.to,
+            text="Preauth Cache cleared",
+            in_reply_to=msg
+        )
+        return
+
+    @botcmd
+    def twofa_preauth_cache_info(self, msg: ErrbotMessage, args: Mapping) -> None:
+        """
+        This is a command that returns stats about our Duo preauth cache
+
+        Args:
+            msg (ErrbotMessage): ErrbotMessage object
+            args (Mapping): args
+
+        Returns:
+            None
+        """
+        cache_info = self.preauth_user.cache_info()
+        self.send(
+            msg.to,
+            text=f"Preauth Cache Info\nHits: {cache_info.hits}\n"
+                 f"Misses: {cache_info.misses}\n"
+                 f"Max Size {cache_info.maxsize}\n"
+                 f"Current Size: {cache_info.currsize}",
+            in_reply_to=msg
+        )
+        return
+
     @cmdfilter
     def duo2fa_filter(self, msg: ErrbotMessage, cmd: str, args: str, dry_run: bool):
         """
@@ -251,30 +505,37 @@ class Duo2fa(BotPlugin):
         Returns:
             Union((ErrbotMessage, str, Dict), (None, None, None))
         """
+        # FAST PATH: !help and similar invoke dry-run on every command for every user; must not touch persistent
+        # storage or parse args here. Keep this the first statement of the filter.
+        if dry_run:
+            return msg, cmd, args
+
         self.log.debug(f"Start of filter {cmd} {args}")
-        # right at the beginning, lets parse out the 2fa args, which will strip them from the args string as well
+        # lets parse out the 2fa args, which will strip them from the args string as well
         # this lets us remove --2fa [method] from all cmds, in case someone passes it on a command that doesn't require
         # --2fa
-        twofa_method, args = self.parse_2fa_args(args)
+        twofa_method, args = parse_2fa_args(args)
         self.log.debug(f"after parse {cmd} {args}")
 
-        if dry_run:
+        # check the in memory copy of filtered_commands so we don't touch storage on every command
+        # if cmd is not in our filtered cmd list, return immediately so the cmd executes
+        if cmd not in self._filtered_commands:
             return msg, cmd, args
 
-        with self.stored('filtered_commands') as filtered_commands:
-            # if cmd is not in our filtered cmd list, return immediately so the cmd executes
-            if cmd not in filtered_commands:
-                return msg, cmd, args
-
         # at this point, we know this cmd is filtered and we need to 2fa the user
         # if twofa_method is None, then they didn't pass --2fa
         if twofa_method is None:
             self.send(
                 msg.to,
-                text="This command requires Duo Two Factor. Rerun this command with --2fa.\n"
-                     "You can specify your preferred 2fa method after --2fa like this `--2fa sms`\n"
-                     "Just sending --2fa is the same as --2fa auto. Allowed 2fa Methods:\n"
-                     "auto\npush\nphone\nsms",
+                text=_MSG_REQUIRES_2FA,
+                in_reply_to=msg
+            )
+            return None, None, None
+
+        if twofa_method not in _VALID_2FA_METHODS:
+            self.send(
+                msg.to,
+                text=_MSG_INVALID_METHOD_TPL.format(twofa_method),
                 in_reply_to=msg
             )
             return None, None, None
@@ -287,10 +548,18 @@ class Duo2fa(BotPlugin):
             self.log.error("Unsupported backed for user email lookup. Unable to do Duo 2fa ")
             self.send(
                 msg.to,
-                test="Fatal error: Your backend does not support user emails. All Duo 2fa commands will fail. "
-                     "Contact your bot admins to disable Duo 2fa",
+                text=_MSG_UNSUPPORTED_BACKEND,
                 in_reply_to=msg
+            )
+            return None, None, None
 
+        # lookup failures are never cached, so don't hand the sentinel to Duo as if it were an email
+        if user_email == "Slack API Error":
+            self.log.error("Slack API error during user email lookup. Unable to do Duo 2fa")
+            self.send(
+                msg.to,
+                text=_MSG_SLACK_ERROR,
+                in_reply_to=msg
             )
             return None, None, None
 
@@ -300,65 +569,147 @@ class Duo2fa(BotPlugin):
             self.log.debug(f"Error talking to Duo api {error}")
             self.send(
                 msg.to,
-                text=f"Fatal Error when talking to the Duo api {error}",
+                text=_MSG_DUO_API_ERROR_TPL.format(error),
                 in_reply_to=msg
             )
             return None, None, None
 
         self.log.debug(f"LOOK: {user_preauth}")
 
-        # deny means that duo has denied this email auth.
-        if user_preauth == "deny":
-            self.log.debug(f"{user_email} denied by Duo for {cmd}")
+        # dispatch on the preauth result, anything we don't know how to handle blocks the command
+        handler = self._preauth_handlers.get(user_preauth)
+        if handler is None:
+            return None, None, None
+        return handler(msg, cmd, args, twofa_method, user_email, message)
+
+    # Preauth Result Handlers
+    def _handle_preauth_deny(self,
+                             msg: ErrbotMessage,
+                             cmd: str,
+                             args: str,
+                             twofa_method: str,
+                             user_email: str,
+                             message: str) -> Tuple:
+        """
+        deny means that duo has denied this email auth.
+
+        Args:
+            msg (ErrbotMessage): the ErrbotMessage object
+            cmd (str): The command name itself
+            args (str): Args passed to the command, without --2fa
+            twofa_method (str): 2fa method the user asked for
+            user_email (str): Email of the user
+            message (str): Status message from the preauth
+
+        Returns:
+            Tuple(None, None, None)
+        """
+        self.log.debug(f"{user_email} denied by Duo for {cmd}")
+        self.send(
+            msg.to,
+            text=_MSG_DENIED_TPL.format(message),
+            in_reply_to=msg
+        )
+        return None, None, None
+
+    def _handle_preauth_enroll(self,
+                               msg: ErrbotMessage,
+                               cmd: str,
+                               args: str,
+                               twofa_method: str,
+                               user_email: str,
+                               message: str) -> Tuple:
+        """
+        enroll means the user isn't in Duo
+
+        Args:
+            msg (ErrbotMessage): the ErrbotMessage object
+            cmd (str): The command name itself
+            args (str): Args passed to the command, without --2fa
+            twofa_method (str): 2fa method the user asked for
+            user_email (str): Email of the user
+            message (str): Status message from the preauth
+
+        Returns:
+            Tuple(None, None, None)
+        """
+        self.log.debug(f"{user_email} is not enrolled in Duo")
+        self.send(
+            msg.to,
+            text=_MSG_NOT_ENROLLED_TPL.format(user_email),
+            in_reply_to=msg
+        )
+        return None, None, None
+
+    def _handle_preauth_allow(self,
+                              msg: ErrbotMessage,
+                              cmd: str,
+                              args: str,
+                              twofa_method: str,
+                              user_email: str,
+                              message: str) -> Tuple:
+        """
+        allow means duo has allowed this user without further auth
+
+        Args:
+            msg (ErrbotMessage): the ErrbotMessage object
+            cmd (str): The command name itself
+            args (str): Args passed to the command, without --2fa
+            twofa_method (str): 2fa method the user asked for
+            user_email (str): Email of the user
+            message (str): Status message from the preauth
+
+        Returns:
+            Tuple(ErrbotMessage, str, str)
+        """
+        self.log.debug(f"{user_email} allowed without 2fa by duo for {cmd}")
+        return msg, cmd, args
+
+    def _handle_preauth_auth(self,
+                             msg: ErrbotMessage,
+                             cmd: str,
+                             args: str,
+                             twofa_method: str,
+                             user_email: str,
+                             message: str) -> Tuple:
+        """
+        auth means that we can do an auth with this user.
+
+        Args:
+            msg (ErrbotMessage): the ErrbotMessage object
+            cmd (str): The command name itself
+            args (str): Args passed to the command, without --2fa
+            twofa_method (str): 2fa method the user asked for
+            user_email (str): Email of the user
+            message (str): Status message from the preauth
+
+        Returns:
+            Union((ErrbotMessage, str, str), (None, None, None))
+        """
+        self.log.debug(f"{user_email} needs to 2fa auth via Duo for {cmd}")
+
+        try:
+            twofa_result, message = self.auth_user(user_email, twofa_method)
+        except RuntimeError as error:
+            self.log.debug(f"Error talking to Duo api {error}")
             self.send(
                 msg.to,
-                text=f"Error: You are not authorized to auth to Duo at this time. Please contact your Duo admin."
-                     f"\nDuo Error message: {message}",
+                text=_MSG_DUO_API_ERROR_TPL.format(error),
                 in_reply_to=msg
             )
             return None, None, None
 
-        # enroll means the user isn't in Duo
-        if user_preauth == "enroll":
-            self.log.debug(f"{user_email} is not enrolled in Duo")
+        if twofa_result == "deny":
             self.send(
                 msg.to,
-                text=f"Error: You are not enrolled in Duo. Please contact your Duo admin.\nUser Email: {user_email}",
+                text=_MSG_AUTH_FAILED_PREFIX + message,
                 in_reply_to=msg
             )
             return None, None, None
 
-        # allow means duo has allowed this user without further auth
-        if user_preauth == "allow":
-            self.log.debug(f"{user_email} allowed without 2fa by duo for {cmd}")
+        if twofa_result == "allow":
             return msg, cmd, args
 
-        # auth means that we can do an auth with this user.
-        if user_preauth == "auth":
-            self.log.debug(f"{user_email} needs to 2fa auth via Duo for {cmd}")
-
-            try:
-                twofa_result, message = self.auth_user(user_email, twofa_method)
-            except RuntimeError as error:
-                self.log.debug(f"Error talking to Duo api {error}")
-                self.send(
-                    msg.to,
-                    text=f"Fatal Error when talking to the Duo api {error}",
-                    in_reply_to=msg
-                )
-                return None, None, None
-
-            if twofa_result == "deny":
-                self.send(
-                    msg.to,
-                    text=f"Your Duo 2FA auth failed.\nError message: {message}",
-                    in_reply_to=msg
-                )
-                return None, None, None
-
-            if twofa_result == "allow":
-                return msg, cmd, args
-
         return None, None, None
 
     # Helper Functions
@@ -366,6 +717,9 @@ class Duo2fa(BotPlugin):
     def stored(self, key: str):
         """
         This is a context helper to ease the mutability of the internal plugin storage
+
+        Don't use it for filtered_commands. duo2fa_filter checks an in memory copy that only add_command(s) and
+        remove_command(s) keep in step with storage
         Args:
             key (str): The key you want to retrieve from our internal storage
 
@@ -386,26 +740,76 @@ class Duo2fa(BotPlugin):
             command (str): The command to filter
 
         """
-        self.log.debug(f"add_command called from {inspect.stack()[1][3]} with {command}")
-        with self.stored('filtered_commands') as cmds:
-            cmds.add(command)
+        self.log.debug(f"add_command called from {sys._getframe(1).f_code.co_name} with {command}")
+        self._filtered_commands = self._filtered_commands | {command}
+        # storage keeps a plain set, as it always has
+        self['filtered_commands'] = set(self._filtered_commands)
 
     def remove_command(self,
                        command: str)->None:
         """
-        Adds a command to our filter
+        Removes a command from our filter
 
         Also called by other plugins wanting to add remove their commands from the filter
         Args:
-            command (str): The command to filter
+            command (str): The command to stop filtering
 
         """
-        self.log.debug(f"remove_command called from {inspect.stack()[1][3]} with {command}")
-        with self.stored('filtered_commands') as cmds:
-            try:
-                cmds.remove(command)
-            except KeyError as error_msg:
-                self.log.error(f"Tried to remove {command} that is not in filtered_commands. Error: {error_msg}")
+        self.log.debug(f"remove_command called from {sys._getframe(1).f_code.co_name} with {command}")
+        # nothing changed, so skip writing the set back to storage
+        if command not in self._filtered_commands:
+            self.log.error(f"Tried to remove {command} that is not in filtered_commands")
+            return
+
+        self._filtered_commands = self._filtered_commands - {command}
+        # storage keeps a plain set, as it always has
+        self['filtered_commands'] = set(self._filtered_commands)
+
+    def add_commands(self,
+                     commands: Iterable[str])->None:
+        """
+        Adds several commands to our filter with a single storage write
+
+        Preferred over calling add_command in a loop for plugins adding many commands on activation
+        Args:
+            commands (Iterable[str]): The commands to filter
+
+        Raises:
+            TypeError: commands is a single str rather than a collection of commands
+
+        """
+        commands = _command_set(commands)
+        self.log.debug(f"add_commands called from {sys._getframe(1).f_code.co_name} with {commands}")
+        self._filtered_commands = self._filtered_commands | commands
+        # storage keeps a plain set, as it always has
+        self['filtered_commands'] = set(self._filtered_commands)
+
+    def remove_commands(self,
+                        commands: Iterable[str])->None:
+        """
+        Removes several commands from our filter with a single storage write
+
+        Preferred over calling remove_command in a loop for plugins removing many commands
+        Args:
+            commands (Iterable[str]): The commands to stop filtering
+
+        Raises:
+            TypeError: commands is a single str rather than a collection of commands
+
+        """
+        commands = _command_set(commands)
+        self.log.debug(f"remove_commands called from {sys._getframe(1).f_code.co_name} with {commands}")
+        missing_commands = commands - self._filtered_commands
+        if missing_commands:
+            self.log.error(f"Tried to remove {missing_commands} that are not in filtered_commands")
+
+        # nothing changed, so skip writing the set back to storage
+        if missing_commands == commands:
+            return
+
+        self._filtered_commands = self._filtered_commands - commands
+        # storage keeps a plain set, as it always has
+        self['filtered_commands'] = set(self._filtered_commands)
 
     def get_user_email(self, person) -> str:
         """
@@ -415,23 +819,24 @@ class Duo2fa(BotPlugin):
         Returns:
             str - Email for the user, or Unsupported Backend
         """
+        # in test mode, let's just return a junk email
+        if self._test_mode:
+            return "test@test.com"
 
-        try:
-            return person.email()
-        except AttributeError:
-            # we're either running an older errbot-slack that doesn't have the _email merged in, or not the slack backend
-            pass
+        # errbot 6 identities expose email as a property, older backends as a method. Older errbot-slack versions
+        # and other backends may not have it at all, or leave it empty
+        email = getattr(person, "email", None)
+        if callable(email):
+            email = email()
+        if email:
+            return email
 
-        bot_mode = self._bot.mode
+        bot_mode = self._bot_mode
         self.log.debug("get_user_email called")
-        # in test mode, let's just return a junk email
-        if bot_mode == "test":
-            self.log.debug("get_user_email in test mode - returning test@test.com")
-            return "test@test.com"
 
         # OK, slack backend we need to do an API call
         if bot_mode == "slack":
-            self.log.debug(f"HelperPlugin::get_user_email in slack mode - querying slack for {user_id} email")
+            self.log.debug(f"HelperPlugin::get_user_email in slack mode - querying slack for {person} email")
             try:
                 return self.get_email_via_api(person.user_id())
             except RuntimeError:
@@ -440,10 +845,30 @@ class Duo2fa(BotPlugin):
         self.log.debug(f"HelperPlugin::get_user_email in unknown mode - {bot_mode}. Returning Unsupported")
         return "Unsupported Backend"
 
-    @lru_cache(maxsize=256)
-    def get_email_via_api(self, user_id: str) -> str:
+    def warm_email_cache(self, user_ids: List[str]) -> None:
+        """
+        Looks up emails for a list of user ids so the first 2fa command from those users doesn't wait on slack
+
+        Run in a background thread by activate when WARMUP_USER_IDS is configured
+        Args:
+            user_ids (List[str]): user ids to look up
+
+        Returns:
+            None
+        """
+        for user_id in user_ids:
+            try:
+                self.get_email_via_api(user_id)
+            except Exception as error:
+                # anything from the slack client, not just our RuntimeError, must not end the thread and skip the
+                # rest of the ids
+                self.log.error(f"Unable to warm email cache for {user_id}. {error}")
+
+    def _get_email_via_api(self, user_id: str) -> str:
         """
         get_user_email uses the slack api to get a user's email by their user id
+
+        Cached per instance as self.get_email_via_api
         Args:
             user_id (str): user id to look up
 
@@ -459,10 +884,11 @@ class Duo2fa(BotPlugin):
             self.log.error(f"Slack error when looking up email for {user_id}")
             raise RuntimeError("Slack Error")
 
-    @lru_cache(maxsize=4)
-    def preauth_user(self, user_email: str) -> Tuple[str, str]:
+    def _preauth_user(self, user_email: str) -> Tuple[str, str]:
         """
         Preauths a user against duo
+
+        Cached per instance as self.preauth_user
         Args:
             user_email (str): Email of the user to auth
 
@@ -485,43 +911,3 @@ class Duo2fa(BotPlugin):
         """
         response = self.duo_auth_api.auth(username=user_email, factor=factor)
         return response['result'], response['status_msg']
-
-    @staticmethod
-    @lru_cache(maxsize=32)
-    def parse_2fa_args(args: str) -> Tuple[str, str]:
-        """
-        Parses the 2fa method out of args and returns the args string without 2fa in it
-        Args:
-            args (str): args to parse
-
-        Returns:
-            Tuple(str, str) - twofa_method, args without --2fa method
-        """
-
-        # if --2fa isn't in our args, return None and args unmodified
-        if "--2fa" not in args:
-            return None, args
-
-        # ok, we have at least --2fa. Lets check if they sent along a 2fa method with it
-        args_list = args.split(" ")
-        twofa_position = args_list.index("--2fa")
-        try:
-            # grab the next word after --2fa
-            method_pos = twofa_position + 1
-            twofa_method = args_list[method_pos]
-
-            # if its a flag (starts with --) then we want auto (they passed just --2fa)
-            if twofa_method.startswith("--"):
-                twofa_method = "auto"
-                method_pos = None
-        except IndexError:
-            # they passed just --2fa at the end of the args
-            twofa_method = "auto"
-            method_pos = None
-
-        # delete --2fa and the 2fa method from args
-        if method_pos is not None:
-            del args_list[method_pos]
-        del args_list[twofa_position]
-
-        return twofa_method.lower(), " ".join(args_list)
@@ -1,299 +1,679 @@
-import hashlib
-import uuid
+import inspect
+import os
+import sys
+import threading
+import time
 
-pytest_plugins = ["errbot.backends.test"]
+from types import SimpleNamespace
+
+import pytest
+
+from errbot.backends import test as errbot_test
+from errbot.botplugin import ValidationException
+
+from duo2fa import parse_2fa_args
 
 extra_plugin_dir = "."
 
+# seconds to wait for a reply. Replies from our mocked commands arrive well within this, so a missing reply fails the
+# test quickly instead of waiting out errbot's 5 second default
+POP_TIMEOUT = 1
+
+
+def pop(testbot, timeout: float = POP_TIMEOUT) -> str:
+    """
+    Pops the next reply from the testbot, failing after timeout seconds if there isn't one
+
+    """
+    return testbot.pop_message(timeout=timeout)
+
+
+@pytest.fixture(scope="module")
+def testbot():
+    """
+    One bot for the whole module, instead of errbot's testbot fixture starting a new bot for every test
+
+    reset_duo_plugin puts the plugin back the way activate left it after each test
+    """
+    bot = errbot_test.TestBot(extra_plugin_dir=extra_plugin_dir)
+    bot.start()
+    yield bot
+    bot.stop()
+
+
+@pytest.fixture
+def duo_plugin(testbot):
+    """
+    The activated Duo2fa plugin for the current testbot
+
+    """
+    return testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
+
 
-class MockDuoAuthClient(object):
-    def __init__(self):
-        self.preauth_json = dict()
-        self.auth_json = dict()
-        self.preauth_raise_error = False
-        self.auth_raise_error = False
-        self.preauth_call_count = 0
-        self.auth_call_count = 0
+# plugin attributes tests swap out, put back after every test
+_SWAPPED_ATTRIBUTES = ("config", "duo_auth_api", "preauth_user", "_test_mode", "_bot_mode")
 
-    def preauth(self, username):
-        self.preauth_call_count += 1
-        if self.preauth_raise_error:
-            raise RuntimeError("Error raised")
-        return self.preauth_json
 
-    def auth(self, username, factor):
-        self.auth_call_count += 1
-        if self.auth_raise_error:
-            raise RuntimeError("Error raised")
-        return self.auth_json
+@pytest.fixture(autouse=True)
+def reset_duo_plugin(testbot, duo_plugin, monkeypatch):
+    """
+    Undoes whatever a test did to the shared plugin: swapped attributes, stored commands, cached lookups and
+    unread replies
+
+    """
+    for attribute in _SWAPPED_ATTRIBUTES:
+        monkeypatch.setattr(duo_plugin, attribute, getattr(duo_plugin, attribute))
+    yield
+    monkeypatch.undo()
+    duo_plugin['filtered_commands'] = set()
+    duo_plugin._filtered_commands = frozenset()
+    duo_plugin.preauth_user.cache_clear()
+    duo_plugin.get_email_via_api.cache_clear()
+    testbot.bot.zap_queues()
+
+
+def make_mock_duo(preauth_json=None, auth_json=None, preauth_raise_error=False, auth_raise_error=False):
+    """
+    Builds a stand in for duo_client.Auth
+
+    preauth and auth count their calls, then hand off to a function that either returns their json or raises.
+    set_preauth_raise and set_auth_raise swap that function, so tests can change behaviour between calls
+    Args:
+        preauth_json (dict): returned by preauth
+        auth_json (dict): returned by auth
+        preauth_raise_error (bool): preauth raises RuntimeError when True
+        auth_raise_error (bool): auth raises RuntimeError when True
+
+    Returns:
+        SimpleNamespace
+    """
+    state = SimpleNamespace(preauth_json=preauth_json if preauth_json is not None else dict(),
+                            auth_json=auth_json if auth_json is not None else dict(),
+                            preauth_call_count=0,
+                            auth_call_count=0)
+
+    def raise_error():
+        raise RuntimeError("Error raised")
+
+    def set_preauth_raise(should_raise: bool):
+        state.preauth_result = raise_error if should_raise else lambda: state.preauth_json
+
+    def set_auth_raise(should_raise: bool):
+        state.auth_result = raise_error if should_raise else lambda: state.auth_json
+
+    def preauth(username):
+        state.preauth_call_count += 1
+        return state.preauth_result()
+
+    def auth(username, factor):
+        state.auth_call_count += 1
+        return state.auth_result()
+
+    set_preauth_raise(preauth_raise_error)
+    set_auth_raise(auth_raise_error)
+    state.set_preauth_raise = set_preauth_raise
+    state.set_auth_raise = set_auth_raise
+    state.preauth = preauth
+    state.auth = auth
+    return state
 
 
 # Tests for setup methods
-def test_hash(testbot):
+def test_configure(duo_plugin):
     """
-    tests __hash__
+    tests configure
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
-    our_uuid = str(uuid.uuid4())
-    plugin.cache_id = our_uuid
+    env_default = sys.modules[duo_plugin.__module__].env_default
+
+    duo_plugin.configure({"DUO_API_HOST": "api.example.com"})
+    assert duo_plugin.config["DUO_API_HOST"] == "api.example.com"
+    assert duo_plugin.config["DUO_INT_KEY"] == os.environ["DUO_INT_KEY"]
+    assert duo_plugin.config["DUO_SECRET_KEY"] == os.environ["DUO_SECRET_KEY"]
+
+    # env defaults are only read once
+    duo_plugin.configure(None)
+    misses = env_default.cache_info().misses
+    duo_plugin.configure(None)
+    assert env_default.cache_info().misses == misses
+    assert duo_plugin.config["DUO_API_HOST"] == os.environ["DUO_API_HOST"]
+    assert duo_plugin.config["WARMUP_USER_IDS"] == []
+
+    # a comma separated str from the chat config is split into user ids
+    duo_plugin.configure({"WARMUP_USER_IDS": "U1, U2"})
+    assert duo_plugin.config["WARMUP_USER_IDS"] == ["U1", "U2"]
+    assert duo_plugin.config["PREAUTH_TTL"] == 300
+    duo_plugin.configure({"PREAUTH_TTL": "600"})
+    assert duo_plugin.config["PREAUTH_TTL"] == 600
+
+
+@pytest.mark.parametrize("preauth_ttl", ["five minutes", "0", "-1"])
+def test_configure_rejects_bad_preauth_ttl(duo_plugin, monkeypatch, request, preauth_ttl):
+    """
+    tests configure rejects a PREAUTH_TTL from the environment that isn't a positive integer
 
-    assert hash(hashlib.md5(f"Duo2fa-{plugin.cache_id}".encode('utf-8')).hexdigest()) == plugin.__hash__()
+    """
+    env_default = sys.modules[duo_plugin.__module__].env_default
+    # env_default caches what it read, so drop the bad value once the environment is restored
+    env_default.cache_clear()
+    request.addfinalizer(env_default.cache_clear)
+    monkeypatch.setenv("PREAUTH_TTL", preauth_ttl)
+
+    with pytest.raises(ValidationException):
+        duo_plugin.configure(None)
+
+
+def test_activate_warms_email_cache(duo_plugin, monkeypatch):
+    """
+    tests activate looks up the WARMUP_USER_IDS emails in a background thread on slack
+
+    """
+    warmed = threading.Event()
+    warmed_user_ids = list()
+
+    def mock_warm_email_cache(user_ids):
+        warmed_user_ids.extend(user_ids)
+        warmed.set()
+
+    monkeypatch.setattr(duo_plugin, "warm_email_cache", mock_warm_email_cache)
+    monkeypatch.setattr(duo_plugin, "_bot_mode", "slack")
+    duo_plugin.configure({"WARMUP_USER_IDS": "U1,U2"})
+    # activate opens storage, so close it first
+    duo_plugin.deactivate()
+    duo_plugin.activate()
+
+    assert warmed.wait(timeout=5)
+    assert warmed_user_ids == ["U1", "U2"]
+
+
+def test_check_configuration(duo_plugin, monkeypatch):
+    """
+    tests check_configuration skips the Duo credential check in test mode
+
+    """
+
+    def mock_auth(**kwargs):
+        raise AssertionError("check_configuration should not build a Duo client in test mode")
+
+    monkeypatch.setattr(sys.modules[duo_plugin.__module__], "Auth", mock_auth)
+
+    duo_plugin.check_configuration({"DUO_API_HOST": "test", "DUO_INT_KEY": "test", "DUO_SECRET_KEY": "test"})
 
 
 # Tests for helper methods
-def test_stored(testbot):
+def test_stored(duo_plugin):
     """
     Tests stored
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
 
-    plugin.add_command("test")
+    duo_plugin['stored_test'] = {"test"}
 
-    with plugin.stored("filtered_commands") as filtered_cmds:
-        assert "test" in filtered_cmds
-        filtered_cmds.add("test2")
+    with duo_plugin.stored("stored_test") as stored_values:
+        assert "test" in stored_values
+        stored_values.add("test2")
 
-    assert "test2" in plugin['filtered_commands']
+    assert duo_plugin['stored_test'] == {"test", "test2"}
+    del duo_plugin['stored_test']
 
 
-def test_add_command(testbot):
+def test_add_command(duo_plugin):
     """
     Tests add_command
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
 
-    assert plugin['filtered_commands'] == set()
+    assert duo_plugin['filtered_commands'] == set()
 
-    plugin.add_command("require_2fa")
-    assert "require_2fa" in plugin['filtered_commands']
+    duo_plugin.add_command("require_2fa")
+    assert "require_2fa" in duo_plugin['filtered_commands']
+    assert "require_2fa" in duo_plugin._filtered_commands
+    # the in memory copy is an immutable snapshot, storage keeps a plain set
+    assert isinstance(duo_plugin._filtered_commands, frozenset)
+    assert isinstance(duo_plugin['filtered_commands'], set)
 
 
-def test_remove_command(testbot):
+def test_remove_command(duo_plugin):
     """
     Tests remove_command
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
 
-    plugin.add_command("require_2fa")
-    assert "require_2fa" in plugin['filtered_commands']
+    duo_plugin.add_command("require_2fa")
+    assert "require_2fa" in duo_plugin['filtered_commands']
+
+    duo_plugin.remove_command("require_2fa")
+    assert "require_2fa" not in duo_plugin['filtered_commands']
+    assert "require_2fa" not in duo_plugin._filtered_commands
 
-    plugin.remove_command("require_2fa")
-    assert "require_2fa" not in plugin['filtered_commands']
+    # removing a command that isn't filtered is a no-op
+    duo_plugin.remove_command("require_2fa")
+    assert "require_2fa" not in duo_plugin['filtered_commands']
 
 
-def test_preauth_user(testbot):
+def test_add_commands(duo_plugin):
+    """
+    Tests add_commands
+
+    """
+
+    duo_plugin.add_commands(["require_2fa", "remove_2fa"])
+    assert duo_plugin['filtered_commands'] == {"require_2fa", "remove_2fa"}
+    assert duo_plugin._filtered_commands == {"require_2fa", "remove_2fa"}
+
+    # a single str is not split into characters
+    with pytest.raises(TypeError):
+        duo_plugin.add_commands("echo")
+    assert duo_plugin['filtered_commands'] == {"require_2fa", "remove_2fa"}
+
+
+def test_remove_commands(duo_plugin):
+    """
+    Tests remove_commands
+
+    """
+
+    duo_plugin.add_commands(["require_2fa", "remove_2fa", "echo"])
+
+    duo_plugin.remove_commands(["require_2fa", "remove_2fa", "not_filtered"])
+    assert duo_plugin['filtered_commands'] == {"echo"}
+    assert duo_plugin._filtered_commands == {"echo"}
+
+    # a single str is not split into characters
+    with pytest.raises(TypeError):
+        duo_plugin.remove_commands("echo")
+    assert duo_plugin['filtered_commands'] == {"echo"}
+
+    # removing commands that aren't filtered is a no-op
+    duo_plugin.remove_commands(["require_2fa"])
+    assert duo_plugin['filtered_commands'] == {"echo"}
+
+
+def test_preauth_user(duo_plugin):
     """
     tests preauth_user
 
     Returns:
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
     # monkeypatch the duo auth client
-    plugin.duo_auth_api = MockDuoAuthClient()
-    plugin.duo_auth_api.preauth_json = {"result": "pass", "status_msg": "pass"}
+    duo_plugin.duo_auth_api = make_mock_duo(preauth_json={"result": "allow", "status_msg": "pass"})
 
-    result, message = plugin.preauth_user("test@test.com")
+    result, message = duo_plugin.preauth_user("test@test.com")
 
-    assert result == "pass"
+    assert result == "allow"
     assert message == "pass"
-    assert plugin.duo_auth_api.preauth_call_count == 1
+    assert duo_plugin.duo_auth_api.preauth_call_count == 1
 
     # test caching
-    result, message = plugin.preauth_user("test@test.com")
-    assert result == "pass"
+    result, message = duo_plugin.preauth_user("test@test.com")
+    assert result == "allow"
     assert message == "pass"
-    assert plugin.duo_auth_api.preauth_call_count == 1
+    assert duo_plugin.duo_auth_api.preauth_call_count == 1
 
+    # test the cached result is only reused a limited number of times
+    for _ in range(9):
+        duo_plugin.preauth_user("test@test.com")
+    assert duo_plugin.duo_auth_api.preauth_call_count == 1
+    duo_plugin.preauth_user("test@test.com")
+    assert duo_plugin.duo_auth_api.preauth_call_count == 2
 
-def test_auth_user(testbot):
+    # test deny and enroll are never cached
+    for result in ("deny", "enroll"):
+        duo_plugin.duo_auth_api = make_mock_duo(preauth_json={"result": result, "status_msg": "pass"})
+        duo_plugin.preauth_user(f"{result}@test.com")
+        duo_plugin.preauth_user(f"{result}@test.com")
+        assert duo_plugin.duo_auth_api.preauth_call_count == 2
+
+
+def test_auth_user(duo_plugin):
     """
     tests auth_user
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
     # monkeypatch the duo auth client
-    plugin.duo_auth_api = MockDuoAuthClient()
-    plugin.duo_auth_api.auth_json = {"result": "pass", "status_msg": "pass"}
+    duo_plugin.duo_auth_api = make_mock_duo(auth_json={"result": "pass", "status_msg": "pass"})
 
-    result, message = plugin.auth_user("test@test.com")
+    result, message = duo_plugin.auth_user("test@test.com")
 
     assert result == "pass"
     assert message == "pass"
 
+    # Duo api errors are left for the caller to handle
+    duo_plugin.duo_auth_api.set_auth_raise(True)
+    with pytest.raises(RuntimeError):
+        duo_plugin.auth_user("test@test.com")
+    assert duo_plugin.duo_auth_api.auth_call_count == 2
 
-def test_parse_2fa_args(testbot):
+
+def test_get_email_via_api(duo_plugin, monkeypatch):
     """
-    tests parse_2fa_args
+    tests get_email_via_api
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
+    duo_plugin.get_email_via_api.cache_clear()
+    api_calls = list()
 
-    # test no 2fa
-    test_args = "stuff"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method is None
-    assert args == "stuff"
+    def mock_api_call(method, user):
+        api_calls.append(user)
+        if user == "UERROR":
+            return {"ok": False}
+        return {"ok": True, "user": {"email": "test@test.com"}}
 
-    # test --2fa on end
-    test_args = "stuff --2fa"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "auto"
-    assert args == "stuff"
+    # monkeypatch the slack api call
+    monkeypatch.setattr(duo_plugin._bot, "api_call", mock_api_call, raising=False)
 
-    # test --2fa push
-    test_args = "stuff --2fa push"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "push"
-    assert args == "stuff"
+    assert duo_plugin.get_email_via_api("U1234") == "test@test.com"
+    assert duo_plugin.get_email_via_api("U1234") == "test@test.com"
+    assert api_calls == ["U1234"]
 
-    # test --2fa SMS
-    test_args = "stuff --2fa SMS"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "sms"
-    assert args == "stuff"
+    # test errors are not cached
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            duo_plugin.get_email_via_api("UERROR")
+    assert api_calls == ["U1234", "UERROR", "UERROR"]
 
-    # test --2fa push --otherflag
-    test_args = "stuff --2fa push --otherflag"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "push"
-    assert args == "stuff --otherflag"
+    cache_info = duo_plugin.get_email_via_api.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.currsize == 1
 
-    # test --2fa --otherflag stuff
-    test_args = "stuff --2fa --otherflag stuff"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "auto"
-    assert args == "stuff --otherflag stuff"
 
+def test_get_user_email(duo_plugin, monkeypatch):
+    """
+    tests get_user_email
+
+    """
+    person = SimpleNamespace(user_id=lambda: "U1234")
+
+    # test mode never looks the user up
+    assert duo_plugin.get_user_email(person) == "test@test.com"
+
+    # backends whose identities have an email use it. errbot exposes it as a property
+    duo_plugin._test_mode = False
+    assert duo_plugin.get_user_email(errbot_test.TestPerson("U1", email="person@test.com")) == "person@test.com"
+
+    # slack looks the email up with the api
+    monkeypatch.setattr(duo_plugin._bot, "api_call",
+                        lambda method, user: {"ok": user != "UERROR", "user": {"email": f"{user}@test.com"}},
+                        raising=False)
+    duo_plugin._bot_mode = "slack"
+    assert duo_plugin.get_user_email(person) == "U1234@test.com"
+    assert duo_plugin.get_user_email(SimpleNamespace(user_id=lambda: "UERROR")) == "Slack API Error"
+
+    # anything else can't look up emails
+    duo_plugin._bot_mode = "irc"
+    assert duo_plugin.get_user_email(person) == "Unsupported Backend"
+
+
+def test_warm_email_cache(duo_plugin, monkeypatch):
+    """
+    tests warm_email_cache
+
+    """
+    duo_plugin.get_email_via_api.cache_clear()
+
+    def mock_api_call(method, user):
+        if user == "UERROR":
+            return {"ok": False}
+        if user == "UDOWN":
+            raise ConnectionError("slack is down")
+        return {"ok": True, "user": {"email": f"{user}@test.com"}}
+
+    # monkeypatch the slack api call
+    monkeypatch.setattr(duo_plugin._bot, "api_call", mock_api_call, raising=False)
+
+    # neither kind of error stops the remaining ids being looked up
+    duo_plugin.warm_email_cache(["U1", "UERROR", "UDOWN", "U2"])
+    cache_info = duo_plugin.get_email_via_api.cache_info()
+    assert cache_info.misses == 4
+    assert cache_info.currsize == 2
+
+    assert duo_plugin.get_email_via_api("U2") == "U2@test.com"
+    assert duo_plugin.get_email_via_api.cache_info().hits == 1
+
+
+def test_get_email_via_api_coalesces(duo_plugin, monkeypatch):
+    """
+    tests concurrent get_email_via_api misses for one user share a single slack call
+
+    """
+    duo_plugin.get_email_via_api.cache_clear()
+    api_calls = list()
+    release = threading.Event()
+
+    def mock_api_call(method, user):
+        api_calls.append(user)
+        release.wait(timeout=5)
+        return {"ok": True, "user": {"email": "test@test.com"}}
+
+    # monkeypatch the slack api call
+    monkeypatch.setattr(duo_plugin._bot, "api_call", mock_api_call, raising=False)
+
+    results = list()
+    threads = [threading.Thread(target=lambda: results.append(duo_plugin.get_email_via_api("U1234")))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    # give every thread time to reach the cache before the slack call returns
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert results == ["test@test.com"] * 3
+    assert api_calls == ["U1234"]
+
+
+@pytest.mark.parametrize("test_args, expected_method, expected_args", [
+    # test no 2fa
+    ("stuff", None, "stuff"),
+    # test --2fa on end
+    ("stuff --2fa", "auto", "stuff"),
+    # test --2fa push
+    ("stuff --2fa push", "push", "stuff"),
+    # test --2fa SMS
+    ("stuff --2fa SMS", "sms", "stuff"),
+    # test --2fa push --otherflag
+    ("stuff --2fa push --otherflag", "push", "stuff --otherflag"),
+    # test --2fa --otherflag stuff
+    ("stuff --2fa --otherflag stuff", "auto", "stuff --otherflag stuff"),
     # test --2fa --otherflag push
-    test_args = "stuff --2fa --otherflag push"
-    method, args = plugin.parse_2fa_args(test_args)
-    assert method == "auto"
-    assert args == "stuff --otherflag push"
+    ("stuff --2fa --otherflag push", "auto", "stuff --otherflag push"),
+    # test --2fa only as part of another flag
+    ("stuff --2fast", None, "stuff --2fast"),
+    # test extra whitespace around --2fa
+    ("stuff  --2fa  push   --otherflag", "push", "stuff --otherflag"),
+    # test trailing whitespace after --2fa is not an empty 2fa method
+    ("stuff --2fa  ", "auto", "stuff"),
+    # test only the first --2fa is parsed
+    ("stuff --2fa sms --2fa push", "sms", "stuff --2fa push"),
+    # test whitespace away from --2fa is left alone
+    ('say "hello   world"\nsecond line --2fa push', "push", 'say "hello   world"\nsecond line'),
+    ("first\tsecond --2fa sms  third\n", "sms", "first\tsecond third"),
+])
+def test_parse_2fa_args(test_args, expected_method, expected_args):
+    """
+    tests parse_2fa_args
+
+    """
+    method, args = parse_2fa_args(test_args)
+    assert method == expected_method
+    assert args == expected_args
 
 
 # Tests for botcmds
-def test_require_2fa(testbot):
+def test_require_2fa(testbot, duo_plugin):
     """
     Tests require_2fa
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
 
-    assert plugin['filtered_commands'] == set()
+    assert duo_plugin['filtered_commands'] == set()
 
     testbot.push_message("!require 2fa test_command")
-    msg = testbot.pop_message()
+    msg = pop(testbot)
     assert msg == "test_command not in our bot's command list. Make sure you are adding the command based on the " \
                   "python function name for the plugin"
 
     testbot.push_message("!require 2fa echo")
-    msg = testbot.pop_message()
+    msg = pop(testbot)
     assert msg == "echo now requires 2fa"
 
     testbot.push_message("!require 2fa echo")
-    msg = testbot.pop_message()
+    msg = pop(testbot)
     assert msg == "echo already requires 2fa"
 
 
-def test_remove_2fa(testbot):
+def test_remove_2fa(testbot, duo_plugin):
     """
     Tests remove_2fa
 
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
 
-    assert plugin['filtered_commands'] == set()
+    assert duo_plugin['filtered_commands'] == set()
 
     testbot.push_message("!remove 2fa test_command")
-    msg = testbot.pop_message()
+    msg = pop(testbot)
     assert msg == "test_command does not require 2fa"
 
-    plugin.add_command("echo")
+    duo_plugin.add_command("echo")
     testbot.push_message("!remove 2fa echo")
-    msg = testbot.pop_message()
+    msg = pop(testbot)
     assert msg == "echo no longer requires 2fa"
 
 
+@pytest.fixture
+def sent_messages(duo_plugin, monkeypatch):
+    """
+    Records the text of everything the plugin sends instead of sending it
+
+    """
+    sent = list()
+    monkeypatch.setattr(duo_plugin, "send", lambda to, text, **kwargs: sent.append(text))
+    return sent
+
+
+def call_botcmd(plugin, name: str, *args):
+    """
+    Calls a botcmd's own function, skipping errbot's dispatch and argument parsing
+
+    """
+    msg = SimpleNamespace(to=None)
+    return inspect.unwrap(getattr(type(plugin), name))(plugin, msg, *args)
+
+
+def test_require_2fa_direct(duo_plugin, sent_messages):
+    """
+    Tests require_2fa without going through the bot
+
+    """
+    call_botcmd(duo_plugin, "require_2fa", "test_command")
+    call_botcmd(duo_plugin, "require_2fa", "echo")
+    call_botcmd(duo_plugin, "require_2fa", "echo")
+
+    assert sent_messages == [
+        "test_command not in our bot's command list. Make sure you are adding the command based on the python "
+        "function name for the plugin",
+        "echo now requires 2fa",
+        "echo already requires 2fa",
+    ]
+    assert duo_plugin['filtered_commands'] == {"echo"}
+
+
+def test_remove_2fa_direct(duo_plugin, sent_messages):
+    """
+    Tests remove_2fa without going through the bot
+
+    """
+    duo_plugin.add_command("echo")
+
+    call_botcmd(duo_plugin, "remove_2fa", "test_command")
+    call_botcmd(duo_plugin, "remove_2fa", "echo")
+
+    assert sent_messages == ["test_command does not require 2fa", "echo no longer requires 2fa"]
+    assert duo_plugin['filtered_commands'] == set()
+
+
+def test_twofa_preauth_cache(testbot, duo_plugin):
+    """
+    Tests twofa_preauth_cache_info and twofa_preauth_cache_clear
+
+    """
+    # monkeypatch the duo auth client
+    duo_plugin.duo_auth_api = make_mock_duo(preauth_json={"result": "auth", "status_msg": "pass"})
+    duo_plugin.preauth_user("test@test.com")
+    duo_plugin.preauth_user("test@test.com")
+
+    testbot.push_message("!twofa preauth cache info")
+    msg = pop(testbot)
+    assert msg == "Preauth Cache Info\nHits: 1\nMisses: 1\nMax Size 512\nCurrent Size: 1"
+
+    testbot.push_message("!twofa preauth cache clear")
+    msg = pop(testbot)
+    assert msg == "Preauth Cache cleared"
+    assert duo_plugin.preauth_user.cache_info().currsize == 0
+
+
 # Test the cmdfilter
-def test_duo2fa_filter(testbot):
+# preauth result that sends the user on to a Duo auth
+_PREAUTH_AUTH = {"result": "auth", "status_msg": "Error message"}
+
+
+@pytest.mark.parametrize("twofa_args, mock_duo_kwargs, expected_msg", [
+    pytest.param("--2fa carrier_pigeon", {},
+                 "carrier_pigeon is not a valid 2fa method. Allowed 2fa Methods:\nauto\npush\nphone\nsms",
+                 id="invalid method"),
+    pytest.param("--2fa", {"preauth_raise_error": True},
+                 "Fatal Error when talking to the Duo api Error raised",
+                 id="preauth error"),
+    pytest.param("--2fa", {"preauth_json": {"result": "deny", "status_msg": "Error message"}},
+                 "Error: You are not authorized to auth to Duo at this time. Please contact your Duo admin."
+                 "\nDuo Error message: Error message",
+                 id="preauth deny"),
+    pytest.param("--2fa", {"preauth_json": {"result": "enroll", "status_msg": "Error message"}},
+                 "Error: You are not enrolled in Duo. Please contact your Duo admin.\nUser Email: test@test.com",
+                 id="preauth enroll"),
+    pytest.param("--2fa", {"preauth_json": {"result": "allow", "status_msg": "Error message"}},
+                 "Email Lookup Cache cleared",
+                 id="preauth allow"),
+    pytest.param("--2fa", {"preauth_json": _PREAUTH_AUTH, "auth_raise_error": True},
+                 "Fatal Error when talking to the Duo api Error raised",
+                 id="auth error"),
+    pytest.param("--2fa",
+                 {"preauth_json": _PREAUTH_AUTH, "auth_json": {"result": "deny", "status_msg": "Error message"}},
+                 "Your Duo 2FA auth failed.\nError message: Error message",
+                 id="auth deny"),
+    pytest.param("--2fa",
+                 {"preauth_json": _PREAUTH_AUTH, "auth_json": {"result": "allow", "status_msg": "Error message"}},
+                 "Email Lookup Cache cleared",
+                 id="auth allow"),
+])
+def test_duo2fa_filter(testbot, duo_plugin, twofa_args, mock_duo_kwargs, expected_msg):
     """
     Tests duo2fa_filter
 
+    reset_duo_plugin clears the preauth cache between scenarios, so no result is cached from an earlier one
     """
-    plugin = testbot.bot.plugin_manager.get_plugin_obj_by_name("Duo2fa")
     # monkeypatch the duo auth client
-    plugin.duo_auth_api = MockDuoAuthClient()
+    duo_plugin.duo_auth_api = make_mock_duo(**mock_duo_kwargs)
 
     # we're going to use !twofa email cache clear for our testing command
-    plugin.add_command("twofa_email_cache_clear")
-
-    # test preauth duo error
-    plugin.duo_auth_api.preauth_raise_error = True
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Fatal Error when talking to the Duo api Error raised"
-
-    # test preauth duo deny
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "deny", "status_msg": "Error message"}
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Error: You are not authorized to auth to Duo at this time. Please contact your Duo admin." \
-                  "\nDuo Error message: Error message"
-
-    plugin.preauth_user.cache_clear()
-
-    # test preauth enroll
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "enroll", "status_msg": "Error message"}
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Error: You are not enrolled in Duo. Please contact your Duo admin.\nUser Email: test@test.com"
-
-    plugin.preauth_user.cache_clear()
-
-    # test preauth allow
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "allow", "status_msg": "Error message"}
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Email Lookup Cache cleared"
-
-    plugin.preauth_user.cache_clear()
-
-    # test preauth duo auth, auth errors
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "auth", "status_msg": "Error message"}
-    plugin.duo_auth_api.auth_raise_error = True
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Fatal Error when talking to the Duo api Error raised"
-
-    plugin.preauth_user.cache_clear()
-
-    # test preauth duo auth, auth deny
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "auth", "status_msg": "Error message"}
-    plugin.duo_auth_api.auth_raise_error = False
-    plugin.duo_auth_api.auth_json = {"result": "deny", "status_msg": "Error message"}
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Your Duo 2FA auth failed.\nError message: Error message"
-
-    plugin.preauth_user.cache_clear()
-
-    # test preauth duo auth, auth allow
-    plugin.duo_auth_api.preauth_raise_error = False
-    plugin.duo_auth_api.preauth_json = {"result": "auth", "status_msg": "Error message"}
-    plugin.duo_auth_api.auth_raise_error = False
-    plugin.duo_auth_api.auth_json = {"result": "allow", "status_msg": "Error message"}
-    testbot.push_message("!twofa email cache clear --2fa")
-    msg = testbot.pop_message()
-    assert msg == "Email Lookup Cache cleared"
+    duo_plugin.add_command("twofa_email_cache_clear")
+
+    testbot.push_message(f"!twofa email cache clear {twofa_args}")
+    msg = pop(testbot)
+    assert msg == expected_msg
+
+
+def test_duo2fa_filter_invalid_method_skips_duo(testbot, duo_plugin):
+    """
+    Tests duo2fa_filter rejects an invalid 2fa method before calling Duo
+
+    """
+    duo_plugin.duo_auth_api = make_mock_duo()
+    duo_plugin.add_command("twofa_email_cache_clear")
 
+    testbot.push_message("!twofa email cache clear --2fa carrier_pigeon")
+    pop(testbot)
+    assert duo_plugin.duo_auth_api.preauth_call_count == 0
 